@@ -8,12 +8,14 @@ Date: 2025-11-11
 
 import streamlit as st
 import os
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 import pandas as pd
 
 # Import các modules
 from src.input_processing import (
     clean_location_input,
+    lookup_cleaned_location,
     validate_and_geocode,
     normalize_filters,
     build_search_request
@@ -24,11 +26,38 @@ from src.backend_execution import (
     filter_results,
     rank_results
 )
-from src.utils import format_distance
+from src.utils import format_distance, format_distance_array
 
 # Load environment variables
 load_dotenv()
 
+# ============================================================================
+# HELPER FUNCTIONS
+# ============================================================================
+
+@st.cache_data(show_spinner=False)
+def _build_results_df(ranked_rows: tuple) -> pd.DataFrame:
+    """
+    Tạo DataFrame kết quả theo cột (cache theo nội dung kết quả để không
+    phải dựng lại mỗi lần Streamlit rerun)
+    
+    Args:
+        ranked_rows: Tuple các (rank, name, type, distance, score, tags)
+    
+    Returns:
+        DataFrame để hiển thị
+    """
+    ranks, names, types, distances, scores, tags = zip(*ranked_rows)
+    
+    return pd.DataFrame({
+        'Hạng': [f"#{rank}" for rank in ranks],
+        'Tên': names,
+        'Loại': types,
+        'Khoảng cách': format_distance_array(distances).tolist(),
+        'Điểm': [f"{score:.1f}" for score in scores],
+        'Tags': [', '.join(acc_tags) for acc_tags in tags]
+    })
+
 # ============================================================================
 # STREAMLIT PAGE CONFIG
 # ============================================================================
@@ -134,12 +163,23 @@ with st.form("search_form"):
 # XỬ LÝ KHI SUBMIT FORM
 # ============================================================================
 
+new_search = False
+
 if submitted:
     # Validate input
     if not location_input or location_input.strip() == "":
         st.error("❌ Vui lòng nhập tên bãi biển!")
         st.stop()
     
+    # Cùng tham số với lần tìm kiếm trước thì dùng lại kết quả đã lưu
+    query_key = (location_input.strip().lower(), budget_input, type_input, ambiance_input.strip().lower())
+    new_search = query_key != st.session_state.get('last_query')
+
+if new_search:
+    # Xóa kết quả cũ (nếu lần tìm kiếm mới lỗi thì không hiển thị kết quả cũ)
+    st.session_state.pop('ranked', None)
+    st.session_state.pop('last_query', None)
+    
     # Hiển thị progress
     progress_bar = st.progress(0)
     status_text = st.empty()
@@ -147,11 +187,25 @@ if submitted:
     try:
         # ====================================================================
         # BƯỚC 1: AI CLEANING (Giai đoạn 3 - Pattern 1)
+        # Gazetteer/cache có kết quả thì dùng ngay. Chỉ khi phải gọi Gemini
+        # mới geocode input thô song song để không phải chờ 2 lượt gọi API
+        # nối tiếp nhau
         # ====================================================================
         status_text.text("🤖 Đang làm sạch input bằng Gemini AI...")
         progress_bar.progress(10)
         
-        cleaned_location, error = clean_location_input(location_input, gemini_api_key)
+        raw_location = location_input.strip()
+        raw_geo_future = None
+        
+        cleaned_location = lookup_cleaned_location(location_input)
+        error = None
+        if cleaned_location is None:
+            executor = ThreadPoolExecutor(max_workers=1)
+            raw_geo_future = executor.submit(validate_and_geocode, raw_location)
+            # Không chờ geocode input thô nếu kết quả không được dùng tới
+            executor.shutdown(wait=False)
+            
+            cleaned_location, error = clean_location_input(location_input, gemini_api_key)
         
         if error:
             st.error(f"❌ Lỗi AI Cleaning: {error}")
@@ -165,7 +219,11 @@ if submitted:
         status_text.text("🗺️ Đang xác thực địa điểm và lấy tọa độ...")
         progress_bar.progress(30)
         
-        geo_data, error = validate_and_geocode(cleaned_location)
+        # Dùng lại kết quả geocode input thô nếu Gemini không sửa tên
+        if raw_geo_future is not None and cleaned_location.lower() == raw_location.lower():
+            geo_data, error = raw_geo_future.result()
+        else:
+            geo_data, error = validate_and_geocode(cleaned_location)
         
         if error:
             st.error(f"❌ Lỗi Geocoding: {error}")
@@ -198,13 +256,16 @@ if submitted:
         status_text.text("🔍 Đang tìm kiếm trên OpenStreetMap...")
         progress_bar.progress(60)
         
-        osm_elements, error = search_accommodations(search_request)
+        osm_elements, search_radius, error = search_accommodations(search_request)
         
         if error:
             st.warning(f"⚠️ {error}")
             st.info("💡 Thử tìm kiếm với loại hình khác hoặc địa điểm khác")
             st.stop()
         
+        if search_radius < search_request.radius:
+            st.info(f"ℹ️ Server OSM đang quá tải, đã thu hẹp bán kính tìm kiếm còn {format_distance(search_radius / 1000)}")
+        
         st.info(f"📊 Tìm thấy {len(osm_elements)} kết quả thô từ OSM")
         
         # ====================================================================
@@ -248,59 +309,10 @@ if submitted:
         
         st.balloons()
         
-        # ====================================================================
-        # HIỂN THỊ KẾT QUẢ
-        # ====================================================================
-        st.divider()
-        st.subheader(f"🎯 Top {len(ranked)} nơi ở được đề xuất")
-        
-        # Tạo DataFrame để hiển thị
-        df_data = []
-        for acc in ranked:
-            df_data.append({
-                'Hạng': f"#{acc['rank']}",
-                'Tên': acc['name'],
-                'Loại': acc['type'],
-                'Khoảng cách': format_distance(acc['distance']),
-                'Điểm': f"{acc['score']:.1f}",
-                'Tags': ', '.join(acc['tags'][:3])  # Hiển thị 3 tags đầu
-            })
-        
-        df = pd.DataFrame(df_data)
-        
-        # Hiển thị bảng với styling
-        st.dataframe(
-            df,
-            use_container_width=True,
-            hide_index=True
-        )
-        
-        # Hiển thị chi tiết từng kết quả
-        st.divider()
-        st.subheader("📋 Chi tiết từng nơi ở")
-        
-        for acc in ranked:
-            with st.expander(f"#{acc['rank']} - {acc['name']} ⭐ {acc['score']:.1f}"):
-                col1, col2, col3 = st.columns(3)
-                
-                with col1:
-                    st.metric("Khoảng cách", format_distance(acc['distance']))
-                
-                with col2:
-                    st.metric("Loại hình", acc['type'])
-                
-                with col3:
-                    st.metric("Điểm số", f"{acc['score']:.1f}")
-                
-                st.markdown("**Tags:**")
-                st.write(", ".join(acc['tags']))
-                
-                st.markdown("**Tọa độ:**")
-                st.code(f"Lat: {acc['location'][0]:.6f}, Lon: {acc['location'][1]:.6f}")
-                
-                # Link Google Maps
-                gmaps_url = f"https://www.google.com/maps/search/?api=1&query={acc['location'][0]},{acc['location'][1]}"
-                st.markdown(f"[📍 Xem trên Google Maps]({gmaps_url})")
+        # Lưu kết quả để các lần rerun (vd: chọn xem chi tiết) không phải
+        # chạy lại toàn bộ pipeline
+        st.session_state['ranked'] = ranked
+        st.session_state['last_query'] = query_key
         
     except Exception as e:
         st.error(f"❌ Lỗi không xác định: {str(e)}")
@@ -310,6 +322,65 @@ if submitted:
         progress_bar.empty()
         status_text.empty()
 
+# ============================================================================
+# HIỂN THỊ KẾT QUẢ
+# ============================================================================
+
+ranked = st.session_state.get('ranked')
+
+if ranked:
+    st.divider()
+    st.subheader(f"🎯 Top {len(ranked)} nơi ở được đề xuất")
+    
+    # Tạo DataFrame để hiển thị
+    df = _build_results_df(tuple(
+        (acc['rank'], acc['name'], acc['type'], acc['distance'], acc['score'],
+         tuple(acc['tags'][:3]))  # Hiển thị 3 tags đầu
+        for acc in ranked
+    ))
+    
+    # Hiển thị bảng với styling
+    st.dataframe(
+        df,
+        use_container_width=True,
+        hide_index=True
+    )
+    
+    # Hiển thị chi tiết: chỉ render nơi ở đang được chọn
+    st.divider()
+    st.subheader("📋 Chi tiết từng nơi ở")
+    
+    selected_rank = st.radio(
+        "Xem chi tiết:",
+        options=[acc['rank'] for acc in ranked],
+        format_func=lambda rank: f"#{rank} - {ranked[rank - 1]['name']}",
+        horizontal=True
+    )
+    acc = ranked[selected_rank - 1]
+    
+    st.markdown(f"#### #{acc['rank']} - {acc['name']} ⭐ {acc['score']:.1f}")
+    
+    col1, col2, col3 = st.columns(3)
+    
+    with col1:
+        st.metric("Khoảng cách", format_distance(acc['distance']))
+    
+    with col2:
+        st.metric("Loại hình", acc['type'])
+    
+    with col3:
+        st.metric("Điểm số", f"{acc['score']:.1f}")
+    
+    st.markdown("**Tags:**")
+    st.write(", ".join(acc['tags']))
+    
+    st.markdown("**Tọa độ:**")
+    st.code(f"Lat: {acc['location'][0]:.6f}, Lon: {acc['location'][1]:.6f}")
+    
+    # Link Google Maps
+    gmaps_url = f"https://www.google.com/maps/search/?api=1&query={acc['location'][0]},{acc['location'][1]}"
+    st.markdown(f"[📍 Xem trên Google Maps]({gmaps_url})")
+
 # ============================================================================
 # FOOTER
 # ============================================================================
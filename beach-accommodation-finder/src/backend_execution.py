@@ -3,121 +3,235 @@ GIAI ĐOẠN 4: Backend Execution & Ranking
 Bao gồm: Searching, Normalize Output, Filter, Ranking
 """
 
+import math
+import orjson
 import requests
+import sys
+import threading
 import time
-from typing import List, Dict, Optional, Tuple
-from .utils import haversine_distance
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError, as_completed
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, List, Dict, Optional, Tuple
+from .utils import (
+    CHEAP_RULER_MAX_KM,
+    TAG_VOCABULARY,
+    JsonFileCache,
+    create_http_session,
+    haversine_a_rad,
+    haversine_a_to_km,
+    lon_in_box,
+    ruler_distance_sq
+)
+
+if TYPE_CHECKING:
+    from .input_processing import SearchRequest
+
+
+# HTTP sessions dùng chung (tái sử dụng kết nối TLS, tự retry với backoff)
+# Overpass không tự retry HTTP 429/504 mà để _query_overpass_server thu hẹp
+# bán kính rồi thử lại
+_SESSION = create_http_session('BeachAccommodationFinder/1.0')
+_OVERPASS_SESSION = create_http_session('BeachAccommodationFinder/1.0', retry_statuses=(502, 503))
+
+# Cache kết quả Overpass: (lat, lon làm tròn, type, radius)
+# -> {'elements': osm_elements, 'radius': bán kính thực tế đã dùng}
+_SEARCH_CACHE = JsonFileCache('overpass_search.json', ttl=86400, max_entries=200)
 
 
 # ============================================================================
 # PATTERN 5: SEARCHING (OpenStreetMap Overpass API) - CẢI TIẾN
 # ============================================================================
 
-def search_accommodations(search_request: Dict) -> Tuple[Optional[List], Optional[str]]:
+# Danh sách các Overpass API servers (để fallback)
+_OVERPASS_SERVERS = (
+    "https://overpass-api.de/api/interpreter",
+    "https://overpass.kumi.systems/api/interpreter",
+    "https://overpass.openstreetmap.ru/api/interpreter"
+)
+
+# Các loại tourism luôn tìm thêm ngoài loại user chọn (mở rộng tìm kiếm)
+_EXTRA_TOURISM_TYPES = ('hotel', 'guest_house', 'apartment', 'hostel')
+
+# Query tối ưu (ngắn gọn, timeout 20s)
+# nwr = node + way + relation trong 1 lần quét, "out center" trả về
+# tọa độ tâm cho way/relation để không bị bỏ sót khi normalize
+_QUERY_TEMPLATE = """
+    [out:json][timeout:{timeout}];
+    nwr["tourism"~"^({regex})$"](around:{radius},{lat},{lon});
+    out center {limit};
+    """
+
+# Khi server quá tải (HTTP 504/429): thu hẹp bán kính rồi thử lại trên
+# cùng server (bán kính giảm 1/2 thì khối lượng query giảm ~1/4)
+# Mỗi mức: (hệ số chia bán kính, số kết quả tối đa)
+_RADIUS_TIERS = ((1, 50), (2, 30), (4, 30))
+
+# Thời gian tối đa (giây) chờ server đầu tiên trả kết quả
+_OVERPASS_WAIT_TIMEOUT = 25
+
+
+def _tourism_regex(acc_type: str) -> str:
+    """Ghép loại user chọn với các loại mở rộng thành regex alternation"""
+    return "|".join(dict.fromkeys((acc_type,) + _EXTRA_TOURISM_TYPES))
+
+
+# Regex dựng sẵn cho các type mà normalize_filters có thể trả về
+_TOURISM_REGEX_CACHE = {
+    acc_type: _tourism_regex(acc_type)
+    for acc_type in ('hotel', 'guest_house', 'resort', 'chalet', 'hostel')
+}
+
+
+def _query_overpass_server(server_url: str, regex: str, lat: float, lon: float, radius: int,
+                           stop_event: Optional[threading.Event] = None) -> Tuple[Optional[List], int, Optional[str]]:
     """
-    Tìm kiếm nơi ở bằng OpenStreetMap Overpass API với retry và fallback
+    Gửi query tới 1 Overpass server, tự thu hẹp bán kính khi server quá tải
     
     Args:
-        search_request: Dict chứa thông tin tìm kiếm
+        server_url: URL của Overpass server
+        regex: Regex các loại tourism cần tìm
+        lat, lon: Tọa độ tâm tìm kiếm
+        radius: Bán kính tìm kiếm ban đầu (m)
+        stop_event: Được set khi không cần kết quả nữa (server khác đã trả
+            kết quả), khi đó không thử tiếp các mức bán kính
     
     Returns:
-        Tuple (osm_elements, error_message)
-    """
-    # Extract parameters
-    lat = search_request['lat']
-    lon = search_request['lon']
-    acc_type = search_request['type']
-    radius = search_request['radius']
-    
-    # Danh sách các Overpass API servers (để fallback)
-    overpass_servers = [
-        "https://overpass-api.de/api/interpreter",
-        "https://overpass.kumi.systems/api/interpreter",
-        "https://overpass.openstreetmap.ru/api/interpreter"
-    ]
-    
-    # Thử với nhiều loại tourism tags (mở rộng tìm kiếm)
-    tourism_types = [acc_type, 'hotel', 'guest_house', 'apartment', 'hostel']
-    
-    # Xây dựng query tối ưu hơn (ngắn gọn, timeout 20s)
-    query = f"""
-    [out:json][timeout:20];
-    (
-      node["tourism"~"^({"|".join(tourism_types)})$"](around:{radius},{lat},{lon});
-      way["tourism"~"^({"|".join(tourism_types)})$"](around:{radius},{lat},{lon});
-    );
-    out body 50;
+        Tuple (osm_elements, radius_used, error_message)
     """
-    
+    server_name = server_url.split('/')[2]
     last_error = None
     
-    # Thử với từng server
-    for server_url in overpass_servers:
+    for divisor, limit in _RADIUS_TIERS:
+        search_radius = radius // divisor
+        
+        if stop_event is not None and stop_event.is_set():
+            return None, search_radius, f"Server {server_name} đã dừng"
+        
+        query = _QUERY_TEMPLATE.format(
+            timeout=20, regex=regex, radius=search_radius, lat=lat, lon=lon, limit=limit
+        )
+        
         try:
             # Gọi API với timeout 25s
-            response = requests.post(
+            response = _OVERPASS_SESSION.post(
                 server_url, 
                 data={'data': query}, 
-                timeout=25,
-                headers={'User-Agent': 'BeachAccommodationFinder/1.0'}
+                timeout=25
             )
             
             # Kiểm tra status code
             if response.status_code == 200:
-                data = response.json()
+                data = orjson.loads(response.content)
                 
                 # Kiểm tra có elements không
                 if 'elements' in data and len(data['elements']) > 0:
-                    return data['elements'], None
-                else:
-                    # Không có kết quả từ server này, thử server khác
-                    last_error = f"Server {server_url.split('/')[2]} không trả về kết quả"
-                    continue
+                    return data['elements'], search_radius, None
+                
+                return None, search_radius, f"Server {server_name} không trả về kết quả"
             
             elif response.status_code == 504 or response.status_code == 429:
-                # Gateway timeout hoặc rate limit, thử server khác
-                last_error = f"Server {server_url.split('/')[2]} quá tải (HTTP {response.status_code})"
-                time.sleep(2)  # Đợi 2s trước khi thử server khác
+                # Gateway timeout hoặc rate limit, thu hẹp bán kính rồi thử lại
+                last_error = f"Server {server_name} quá tải (HTTP {response.status_code})"
                 continue
             
             else:
-                last_error = f"Server {server_url.split('/')[2]} trả về lỗi HTTP {response.status_code}"
-                continue
-                
+                return None, search_radius, f"Server {server_name} trả về lỗi HTTP {response.status_code}"
+        
         except requests.exceptions.Timeout:
-            last_error = f"Server {server_url.split('/')[2]} timeout"
-            continue
+            return None, search_radius, f"Server {server_name} timeout"
         
         except requests.exceptions.RequestException as e:
-            last_error = f"Lỗi kết nối {server_url.split('/')[2]}: {str(e)}"
-            continue
+            return None, search_radius, f"Lỗi kết nối {server_name}: {str(e)}"
         
         except Exception as e:
-            last_error = f"Lỗi không xác định: {str(e)}"
-            continue
+            return None, search_radius, f"Lỗi không xác định: {str(e)}"
+    
+    return None, search_radius, last_error
+
+
+def search_accommodations(search_request: 'SearchRequest') -> Tuple[Optional[List], Optional[int], Optional[str]]:
+    """
+    Tìm kiếm nơi ở bằng OpenStreetMap Overpass API, gửi song song tới
+    nhiều servers và lấy kết quả thành công đầu tiên
+    
+    Args:
+        search_request: SearchRequest chứa thông tin tìm kiếm
+    
+    Returns:
+        Tuple (osm_elements, radius_used, error_message)
+        - radius_used nhỏ hơn search_request.radius nếu server quá tải
+          và bán kính đã bị thu hẹp
+    """
+    # Extract parameters
+    lat = search_request.lat
+    lon = search_request.lon
+    acc_type = search_request.type
+    radius = search_request.radius
+    
+    # Tra cache trước (làm tròn tọa độ ~100m để gộp các truy vấn gần nhau)
+    cache_key = f"{round(lat, 3)},{round(lon, 3)},{acc_type},{radius}"
+    cached = _SEARCH_CACHE.get(cache_key)
+    if cached is not None:
+        return cached['elements'], cached['radius'], None
+    
+    # Regex các loại tourism (các type phổ biến đã dựng sẵn)
+    regex = _TOURISM_REGEX_CACHE.get(acc_type) or _tourism_regex(acc_type)
+    
+    last_error = None
+    
+    # Gửi query tới tất cả servers cùng lúc, lấy kết quả thành công đầu tiên
+    stop_event = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=len(_OVERPASS_SERVERS))
+    try:
+        futures = [
+            executor.submit(_query_overpass_server, server_url, regex, lat, lon, radius, stop_event)
+            for server_url in _OVERPASS_SERVERS
+        ]
+        
+        for future in as_completed(futures, timeout=_OVERPASS_WAIT_TIMEOUT):
+            elements, radius_used, error = future.result()
+            
+            if error:
+                last_error = error
+                continue
+            
+            # Chỉ cache kết quả đủ bán kính: kết quả đã bị thu hẹp do server
+            # quá tải không được dùng lại cho các lần tìm sau
+            if radius_used == radius:
+                _SEARCH_CACHE.set(cache_key, {'elements': elements, 'radius': radius_used})
+            return elements, radius_used, None
+    
+    except FuturesTimeoutError:
+        last_error = f"Không server nào trả kết quả sau {_OVERPASS_WAIT_TIMEOUT}s"
+    
+    finally:
+        # Báo các server còn lại dừng thử tiếp, không chờ chúng
+        stop_event.set()
+        executor.shutdown(wait=False, cancel_futures=True)
     
     # Nếu tất cả servers đều thất bại
-    return None, f"Không thể kết nối Overpass API. Lỗi cuối: {last_error}"
+    return None, None, f"Không thể kết nối Overpass API. Lỗi cuối: {last_error}"
 
 
 # ============================================================================
 # FALLBACK: TÌM KIẾM BẰNG NOMINATIM (Khi Overpass fail)
 # ============================================================================
 
-def search_accommodations_nominatim_fallback(search_request: Dict) -> Tuple[Optional[List], Optional[str]]:
+def search_accommodations_nominatim_fallback(search_request: 'SearchRequest') -> Tuple[Optional[List], Optional[str]]:
     """
     Tìm kiếm bằng Nominatim API (đơn giản hơn, ít kết quả hơn)
     
     Args:
-        search_request: Dict chứa thông tin tìm kiếm
+        search_request: SearchRequest chứa thông tin tìm kiếm
     
     Returns:
         Tuple (elements, error_message)
     """
     try:
-        lat = search_request['lat']
-        lon = search_request['lon']
-        location_name = search_request['location_name']
+        lat = search_request.lat
+        lon = search_request.lon
+        location_name = search_request.location_name
         
         # Tìm kiếm hotels/accommodations gần địa điểm
         url = "https://nominatim.openstreetmap.org/search"
@@ -129,17 +243,13 @@ def search_accommodations_nominatim_fallback(search_request: Dict) -> Tuple[Opti
             'addressdetails': 1
         }
         
-        headers = {
-            'User-Agent': 'BeachAccommodationFinder/1.0'
-        }
-        
         time.sleep(1)  # Rate limit
-        response = requests.get(url, params=params, headers=headers, timeout=10)
+        response = _SESSION.get(url, params=params, timeout=10)
         
         if response.status_code != 200:
             return None, f"Nominatim fallback thất bại: HTTP {response.status_code}"
         
-        data = response.json()
+        data = orjson.loads(response.content)
         
         if not data or len(data) == 0:
             return None, "Không tìm thấy kết quả"
@@ -166,11 +276,113 @@ def search_accommodations_nominatim_fallback(search_request: Dict) -> Tuple[Opti
         return None, f"Lỗi Nominatim fallback: {str(e)}"
 
 
+# ============================================================================
+# ACCOMMODATION COLUMNS (Structure of Arrays)
+# ============================================================================
+
+# Mỗi tag trong TAG_VOCABULARY ứng với 1 bit để so khớp tags bằng phép AND
+# thay vì tạo set
+_TAG_BITS = {tag: 1 << i for i, tag in enumerate(TAG_VOCABULARY)}
+
+# Bảng tra số bit 1 (popcount) cho mọi mask có thể có
+_POPCOUNT = np.array([bin(m).count('1') for m in range(1 << len(TAG_VOCABULARY))], dtype=np.int64)
+
+
+def tag_mask(tags: List[str]) -> int:
+    """
+    Chuyển danh sách tags thành bitmask (tag ngoài TAG_VOCABULARY bị bỏ qua)
+    
+    Args:
+        tags: Danh sách tags
+    
+    Returns:
+        Bitmask của các tags
+    """
+    mask = 0
+    for tag in tags:
+        mask |= _TAG_BITS.get(tag, 0)
+    return mask
+
+
+@dataclass
+class AccColumns:
+    """
+    Danh sách nơi ở lưu theo cột (mỗi thuộc tính là một mảng) để
+    filter và ranking tính toán vector hóa trên toàn bộ dữ liệu.
+    Chỉ top kết quả cuối cùng mới được chuyển lại thành dict.
+    """
+    ids: np.ndarray        # int64
+    names: np.ndarray      # object (str)
+    lats: np.ndarray       # float64
+    lons: np.ndarray       # float64
+    types: np.ndarray      # object (str)
+    tags: List[List[str]]
+    tag_masks: np.ndarray  # uint64, bitmask theo TAG_VOCABULARY
+    distances: np.ndarray  # float64 (km), được gán khi filter
+    
+    def __len__(self) -> int:
+        return len(self.names)
+    
+    @classmethod
+    def from_lists(cls, ids: List[int], names: List[str], lats: List[float], lons: List[float],
+                   types: List[str], tags: List[List[str]]) -> 'AccColumns':
+        """
+        Tạo AccColumns từ các list giá trị theo cột
+        
+        Args:
+            ids, names, lats, lons, types, tags: Giá trị từng cột
+        
+        Returns:
+            AccColumns (distances = 0)
+        """
+        n = len(names)
+        
+        return cls(
+            ids=np.array(ids, dtype=np.int64),
+            names=np.array(names, dtype=object),
+            lats=np.array(lats, dtype=np.float64),
+            lons=np.array(lons, dtype=np.float64),
+            types=np.array(types, dtype=object),
+            tags=tags,
+            tag_masks=np.fromiter((tag_mask(t) for t in tags), dtype=np.uint64, count=n),
+            distances=np.zeros(n, dtype=np.float64)
+        )
+    
+    def take(self, indices: np.ndarray) -> 'AccColumns':
+        """Lấy ra các nơi ở theo danh sách chỉ số"""
+        return AccColumns(
+            ids=self.ids[indices],
+            names=self.names[indices],
+            lats=self.lats[indices],
+            lons=self.lons[indices],
+            types=self.types[indices],
+            tags=[self.tags[i] for i in indices],
+            tag_masks=self.tag_masks[indices],
+            distances=self.distances[indices]
+        )
+    
+    def to_dict(self, i: int) -> Dict:
+        """Chuyển nơi ở thứ i về dạng Accommodation dict"""
+        return {
+            'id': int(self.ids[i]),
+            'name': self.names[i],
+            'location': (float(self.lats[i]), float(self.lons[i])),
+            'type': self.types[i],
+            'tags': self.tags[i],
+            'score': 0.0,
+            'distance': float(self.distances[i]),
+            'source': 'osm'
+        }
+
+
 # ============================================================================
 # PATTERN 6: NORMALIZE OUTPUT (OSM Data → Accommodation Objects)
 # ============================================================================
 
-def normalize_osm_data(osm_elements: List[Dict]) -> List[Dict]:
+# Tên mặc định khi OSM không có tên (intern để so sánh theo địa chỉ)
+_UNNAMED = sys.intern('Unnamed')
+
+def normalize_osm_data(osm_elements: List[Dict]) -> AccColumns:
     """
     Chuyển đổi dữ liệu thô từ OSM sang cấu trúc Accommodation chuẩn
     
@@ -178,36 +390,53 @@ def normalize_osm_data(osm_elements: List[Dict]) -> List[Dict]:
         osm_elements: List các elements từ OSM Overpass
     
     Returns:
-        List các Accommodation objects (dạng dict)
+        AccColumns chứa các nơi ở (dạng cột)
     """
-    accommodations = []
+    ids = []
+    names = []
+    lats = []
+    lons = []
+    types = []
+    tags_list = []
     seen_names = set()  # Để tránh duplicate
     
+    # Gán sẵn các method vào biến local để vòng lặp không phải tra
+    # attribute mỗi lần
+    ids_append = ids.append
+    names_append = names.append
+    lats_append = lats.append
+    lons_append = lons.append
+    types_append = types.append
+    tags_append = tags_list.append
+    seen_add = seen_names.add
+    intern = sys.intern
+    
     for element in osm_elements:
-        # Chỉ xử lý những element có tags
+        # Loại sớm những element không có tags hoặc không có tọa độ,
+        # trước khi tốn công xử lý tên
         if 'tags' not in element:
             continue
         
+        # Extract coordinates
+        # Với node thì có sẵn lat, lon
+        # Với way/relation thì lấy center (query dùng "out center")
+        coords = element if 'lat' in element else element.get('center')
+        if not coords or 'lat' not in coords or 'lon' not in coords:
+            continue
+        
         tags = element['tags']
+        get = tags.get
         
-        # Extract name
-        name = tags.get('name', tags.get('addr:street', 'Unnamed'))
+        # Extract name (intern để tên trùng nhau dùng chung 1 object,
+        # hash/so sánh trong seen_names nhanh hơn)
+        name = intern(get('name') or get('addr:street') or _UNNAMED)
         
         # Tránh duplicate
         if name in seen_names:
             continue
         
-        # Extract coordinates
-        # Với node thì có sẵn lat, lon
-        # Với way thì cần tính center (đơn giản hóa: bỏ qua way không có lat/lon)
-        if 'lat' not in element or 'lon' not in element:
-            continue
-        
-        lat = element['lat']
-        lon = element['lon']
-        
         # Extract tourism type
-        tourism_type = tags.get('tourism', 'accommodation')
+        tourism_type = get('tourism', 'accommodation')
         
         # Build tags list
         acc_tags = [tourism_type]
@@ -218,66 +447,85 @@ def normalize_osm_data(osm_elements: List[Dict]) -> List[Dict]:
         if 'building' in tags:
             acc_tags.append(tags['building'])
         
-        # Xây dựng Accommodation object
-        accommodation = {
-            'id': element.get('id', 0),
-            'name': name,
-            'location': (lat, lon),
-            'type': tourism_type,
-            'tags': acc_tags,
-            'score': 0.0,
-            'distance': 0.0,
-            'source': 'osm'
-        }
-        
-        accommodations.append(accommodation)
-        seen_names.add(name)
+        # Thêm vào các cột
+        ids_append(element.get('id', 0))
+        names_append(name)
+        lats_append(coords['lat'])
+        lons_append(coords['lon'])
+        types_append(tourism_type)
+        tags_append(acc_tags)
+        seen_add(name)
     
-    return accommodations
+    return AccColumns.from_lists(ids, names, lats, lons, types, tags_list)
 
 
 # ============================================================================
 # PATTERN 7: FILTER RESULTS
 # ============================================================================
 
-def filter_results(accommodations: List[Dict], search_request: Dict) -> List[Dict]:
+def filter_results(accommodations: AccColumns, search_request: 'SearchRequest') -> AccColumns:
     """
     Lọc các kết quả theo criteria
     
     Args:
-        accommodations: List các Accommodation objects
+        accommodations: AccColumns chứa các nơi ở
         search_request: Search request chứa filters
     
     Returns:
-        List các Accommodation đã lọc
+        AccColumns chứa các nơi ở đã lọc (có khoảng cách)
     """
-    filtered = []
+    center_lat = search_request.lat
+    center_lon = search_request.lon
+    max_distance = search_request.radius_km
+    required_tags = search_request.tags
     
-    center_lat = search_request['lat']
-    center_lon = search_request['lon']
-    max_distance = search_request['radius'] / 1000  # Convert m sang km
-    required_tags = search_request.get('tags', [])
+    # Chỉ xét những nơi ở nằm trong bounding box của bán kính tìm kiếm
+    # (chỉ so sánh, không trig)
+    lat_min, lat_max, lon_min, lon_max = search_request.bbox
+    lats = accommodations.lats
+    in_box = (lats >= lat_min) & (lats <= lat_max)
+    in_box &= lon_in_box(accommodations.lons, lon_min, lon_max)
+    candidates = np.flatnonzero(in_box)
     
-    for acc in accommodations:
-        # Tính khoảng cách
-        acc_lat, acc_lon = acc['location']
-        distance = haversine_distance(center_lat, center_lon, acc_lat, acc_lon)
-        
-        # Filter 1: Distance
-        if distance > max_distance:
-            continue
-        
-        # Filter 2: Tags (nếu có required tags)
-        # Nếu không có required tags thì pass
-        if required_tags:
-            # Kiểm tra có ít nhất 1 tag khớp
-            has_match = any(tag in acc['tags'] for tag in required_tags)
-            if not has_match:
-                continue
-        
-        # Pass all filters
-        acc['distance'] = distance
-        filtered.append(acc)
+    # Filter 1: Distance (tính cho các ứng viên cùng lúc bằng NumPy)
+    if max_distance <= CHEAP_RULER_MAX_KM:
+        # Bán kính nhỏ: dùng cheap ruler, so sánh bình phương khoảng cách
+        # nên không cần trig; chỉ lấy sqrt cho những nơi ở được giữ lại
+        ruler = search_request.ruler
+        distances_sq = ruler_distance_sq(
+            ruler, center_lat, center_lon,
+            accommodations.lats[candidates], accommodations.lons[candidates]
+        )
+        keep = distances_sq <= max_distance * max_distance
+        kept = candidates[keep]
+        distances = np.sqrt(distances_sq[keep])
+    else:
+        # Bán kính lớn: dùng Haversine, so sánh a = sin²(c/2) với ngưỡng
+        # nên không cần asin, sqrt cho những nơi ở bị loại
+        sin2_thr = search_request.sin2_half_r_over_R
+        center_lat_rad = math.radians(center_lat)
+        center_lon_rad = math.radians(center_lon)
+        # Chỉ đổi radian/tính cos cho các ứng viên trong bounding box, phía
+        # điểm tìm kiếm dùng cos vĩ độ đã tính sẵn trong search request
+        lats_rad = np.radians(accommodations.lats[candidates])
+        a = haversine_a_rad(
+            center_lat_rad, center_lon_rad, search_request.cos_lat,
+            lats_rad, np.radians(accommodations.lons[candidates]), np.cos(lats_rad)
+        )
+        keep = a <= sin2_thr
+        kept, a = candidates[keep], a[keep]
+        distances = haversine_a_to_km(a)
+    
+    # Filter 2: Tags (nếu có required tags)
+    # Nếu không có required tags thì pass
+    if required_tags:
+        # Kiểm tra có ít nhất 1 tag khớp
+        keep = (accommodations.tag_masks[kept] & np.uint64(tag_mask(required_tags))) != 0
+        kept, distances = kept[keep], distances[keep]
+    
+    # Pass all filters
+    filtered = accommodations.take(kept)
+    filtered.distances = distances
     
     return filtered
 
@@ -286,56 +534,54 @@ def filter_results(accommodations: List[Dict], search_request: Dict) -> List[Dic
 # PATTERN 8: RANKING
 # ============================================================================
 
-def rank_results(accommodations: List[Dict], search_request: Dict) -> List[Dict]:
+def rank_results(accommodations: AccColumns, search_request: 'SearchRequest') -> List[Dict]:
     """
     Xếp hạng các kết quả theo score
     
     Args:
-        accommodations: List các Accommodation đã lọc
+        accommodations: AccColumns chứa các nơi ở đã lọc
         search_request: Search request để tính bonus
     
     Returns:
         List các Accommodation đã xếp hạng (top 5)
     """
-    if not accommodations:
+    if len(accommodations) == 0:
         return []
     
-    required_tags = search_request.get('tags', [])
+    required_mask = np.uint64(tag_mask(search_request.tags))
     
-    for acc in accommodations:
-        score = 10.0  # Base score
-        
-        # Component 1: Proximity score (càng gần càng cao)
-        distance = acc['distance']
-        proximity_score = max(0, 5 - distance)
-        score += proximity_score
-        
-        # Component 2: Tag match score
-        acc_tags = set(acc['tags'])
-        required_tags_set = set(required_tags)
-        tag_matches = len(acc_tags & required_tags_set)
-        tag_score = tag_matches * 2
-        score += tag_score
-        
-        # Component 3: Type bonus (nếu type chính xác khớp)
-        if acc['type'] == search_request['type']:
-            score += 3
-        
-        # Component 4: Name bonus (nếu có tên rõ ràng)
-        if acc['name'] != 'Unnamed':
-            score += 1
-        
-        # Gán score
-        acc['score'] = round(score, 2)
+    # Score tính cho tất cả nơi ở cùng lúc
+    score = np.full(len(accommodations), 10.0)  # Base score
+    
+    # Component 1: Proximity score (càng gần càng cao)
+    score += np.maximum(0, 5 - accommodations.distances)
+    
+    # Component 2: Tag match score
+    tag_matches = _POPCOUNT[accommodations.tag_masks & required_mask]
+    score += tag_matches * 2
+    
+    # Component 3: Type bonus (nếu type chính xác khớp)
+    score += 3 * (accommodations.types == search_request.type)
+    
+    # Component 4: Name bonus (nếu có tên rõ ràng)
+    score += accommodations.names != _UNNAMED
     
-    # Sort theo score giảm dần
-    sorted_accs = sorted(accommodations, key=lambda x: x['score'], reverse=True)
+    score = np.round(score, 2)
     
-    # Lấy top 5
-    top_results = sorted_accs[:5]
+    # Lấy top 5 theo score giảm dần: tìm ngưỡng điểm top 5 bằng
+    # np.partition (O(N)), chỉ sort những nơi ở đạt ngưỡng
+    # (sort stable để nơi ở bằng điểm giữ thứ tự ban đầu)
+    top_k = min(5, len(score))
+    threshold = np.partition(score, len(score) - top_k)[len(score) - top_k]
+    candidates = np.flatnonzero(score >= threshold)
+    top_indices = candidates[np.argsort(-score[candidates], kind='stable')][:top_k]
     
-    # Thêm rank
-    for i, acc in enumerate(top_results):
+    # Chỉ top 5 mới được chuyển thành dict, kèm score và rank
+    top_results = []
+    for i, idx in enumerate(top_indices):
+        acc = accommodations.to_dict(idx)
+        acc['score'] = float(score[idx])
         acc['rank'] = i + 1
+        top_results.append(acc)
     
     return top_results
\ No newline at end of file
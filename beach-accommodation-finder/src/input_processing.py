@@ -3,17 +3,150 @@ GIAI ĐOẠN 3: Input Processing & Enrichment
 Bao gồm: AI Cleaning, Validation, Normalize, Intake Information
 """
 
+import json
+import math
 import os
+import orjson
 import requests
 import time
+import unicodedata
+from dataclasses import dataclass
+from functools import lru_cache
+from types import MappingProxyType
 from typing import Tuple, Dict, List, Optional
 import google.generativeai as genai
+from .utils import (
+    TAG_VOCABULARY,
+    JsonFileCache,
+    bounding_box,
+    create_http_session,
+    haversine_threshold,
+    make_ruler
+)
+
+
+# HTTP session dùng chung cho Nominatim (tái sử dụng kết nối TLS)
+_SESSION = create_http_session('BeachAccommodationFinder/1.0 (Educational Project)')
+
+
+# Cache kết quả AI cleaning: input thô (chuẩn hóa) -> tên địa điểm đã sửa
+_CLEAN_CACHE = JsonFileCache('gemini_clean.json')
+
+# Cache kết quả geocoding: tên địa điểm (chuẩn hóa) -> geo_data
+_GEO_CACHE = JsonFileCache('geocode.json', ttl=86400)
 
 
 # ============================================================================
 # PATTERN 1: AI INPUT CLEANING (Gemini API)
 # ============================================================================
 
+def _fold_text(text: str) -> str:
+    """
+    Bỏ dấu tiếng Việt, chữ thường, gộp khoảng trắng (vd: " Vũng  Tàu" → "vung tau")
+    
+    Args:
+        text: Văn bản cần chuẩn hóa
+    
+    Returns:
+        Văn bản không dấu đã chuẩn hóa
+    """
+    text = text.replace('đ', 'd').replace('Đ', 'D')
+    text = unicodedata.normalize('NFKD', text).encode('ascii', 'ignore').decode()
+    return ' '.join(text.lower().split())
+
+
+def _within_one_edit(a: str, b: str) -> bool:
+    """Kiểm tra 2 chuỗi có khoảng cách Levenshtein <= 1 hay không"""
+    if abs(len(a) - len(b)) > 1:
+        return False
+    if len(a) > len(b):
+        a, b = b, a
+    
+    # Bỏ phần đầu giống nhau, phần còn lại phải khớp sau 1 lần sửa
+    i = 0
+    while i < len(a) and a[i] == b[i]:
+        i += 1
+    if len(a) == len(b):
+        return a[i + 1:] == b[i + 1:]  # Thay 1 ký tự
+    return a[i:] == b[i + 1:]  # Thêm/xóa 1 ký tự
+
+
+def _load_gazetteer() -> Dict[str, str]:
+    """Đọc danh sách địa danh biển phổ biến (tên không dấu → tên chuẩn)"""
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'vn_beaches.json')
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+# Địa danh biển phổ biến: input khớp (hoặc sai 1 ký tự) thì không cần Gemini
+_GAZETTEER = _load_gazetteer()
+
+# Chỉ so khớp gần đúng với tên đủ dài, tránh nhầm giữa các tên ngắn
+_FUZZY_MIN_LENGTH = 5
+
+
+def _lookup_gazetteer(raw_text: str) -> Optional[str]:
+    """
+    Tra tên địa điểm trong gazetteer (khớp chính xác hoặc sai 1 ký tự)
+    
+    Args:
+        raw_text: Văn bản thô người dùng nhập
+    
+    Returns:
+        Tên địa điểm chuẩn hoặc None nếu không tìm thấy
+    """
+    key = _fold_text(raw_text)
+    
+    if key in _GAZETTEER:
+        return _GAZETTEER[key]
+    
+    if len(key) < _FUZZY_MIN_LENGTH:
+        return None
+    
+    # Chỉ nhận khi có đúng 1 tên gần giống, tránh đoán sai
+    matches = [name for k, name in _GAZETTEER.items() if _within_one_edit(key, k)]
+    return matches[0] if len(matches) == 1 else None
+
+
+@lru_cache(maxsize=None)
+def _get_gemini_model(api_key: str) -> genai.GenerativeModel:
+    """
+    Cấu hình Gemini và tạo model 1 lần duy nhất cho mỗi API key
+    
+    Args:
+        api_key: Gemini API key
+    
+    Returns:
+        GenerativeModel dùng chung
+    """
+    genai.configure(api_key=api_key)
+    
+    # ⚠️ THAY ĐỔI MODEL NAME - Dùng gemini-1.5-flash thay vì gemini-pro
+    return genai.GenerativeModel("gemini-2.5-flash")
+
+
+def lookup_cleaned_location(raw_text: str) -> Optional[str]:
+    """
+    Tìm tên địa điểm đã sửa mà không cần gọi Gemini (gazetteer hoặc cache)
+    
+    Args:
+        raw_text: Văn bản thô người dùng nhập
+    
+    Returns:
+        Tên địa điểm đã sửa, hoặc None nếu cần gọi Gemini
+    """
+    # Địa danh biển phổ biến thì trả về ngay
+    known_name = _lookup_gazetteer(raw_text)
+    if known_name:
+        return known_name
+    
+    # Kết quả Gemini đã có trong cache
+    return _CLEAN_CACHE.get(raw_text.strip().lower())
+
+
 def clean_location_input(raw_text: str, api_key: str) -> Tuple[Optional[str], Optional[str]]:
     """
     Sử dụng Gemini API để làm sạch và sửa lỗi tên địa điểm
@@ -31,12 +164,16 @@ def clean_location_input(raw_text: str, api_key: str) -> Tuple[Optional[str], Op
     if not raw_text or raw_text.strip() == "":
         return None, "Input không được để trống"
     
+    # Gazetteer/cache có sẵn kết quả thì không cần gọi Gemini
+    known_name = lookup_cleaned_location(raw_text)
+    if known_name is not None:
+        return known_name, None
+    
+    cache_key = raw_text.strip().lower()
+    
     try:
-        # Cấu hình Gemini
-        genai.configure(api_key=api_key)
-        
-        # ⚠️ THAY ĐỔI MODEL NAME - Dùng gemini-1.5-flash thay vì gemini-pro
-        model = genai.GenerativeModel("gemini-2.5-flash")
+        # Lấy model đã cấu hình sẵn
+        model = _get_gemini_model(api_key)
         
         # Xây dựng prompt
         prompt = f"""Bạn là trợ lý sửa lỗi địa danh Việt Nam.
@@ -57,19 +194,30 @@ Ví dụ:
 
 Trả về:"""
 
-        # Gọi API
-        response = model.generate_content(prompt)
+        # Gọi API dạng stream: kết quả chỉ là 1 dòng tên địa điểm nên
+        # dừng đọc ngay khi đã nhận đủ dòng đầu tiên
+        response = model.generate_content(prompt, stream=True)
+        
+        received = ''
+        for chunk in response:
+            if not chunk.parts:
+                continue
+            received += chunk.text
+            if '\n' in received.strip():
+                break
         
         # Kiểm tra response
-        if not response or not response.text:
+        if not received.strip():
             return None, "Gemini API không trả về kết quả"
         
-        cleaned = response.text.strip()
+        cleaned = received.strip().splitlines()[0].strip()
         
         # Validate cleaned text
         if len(cleaned) < 2 or len(cleaned) > 100:
             return None, "Tên địa điểm không hợp lệ"
         
+        _CLEAN_CACHE.set(cache_key, cleaned)
+        
         return cleaned, None
         
     except Exception as e:
@@ -92,6 +240,12 @@ def validate_and_geocode(location_name: str) -> Tuple[Optional[Dict], Optional[s
         - Nếu thành công: (geo_data_dict, None)
         - Nếu lỗi: (None, error_message)
     """
+    # Tra cache trước, trúng cache thì bỏ qua cả sleep lẫn HTTP request
+    cache_key = location_name.strip().lower()
+    cached = _GEO_CACHE.get(cache_key)
+    if cached is not None:
+        return cached, None
+    
     try:
         # URL của Nominatim API
         url = "https://nominatim.openstreetmap.org/search"
@@ -104,21 +258,17 @@ def validate_and_geocode(location_name: str) -> Tuple[Optional[Dict], Optional[s
             'addressdetails': 1
         }
         
-        # Headers (bắt buộc phải có User-Agent)
-        headers = {
-            'User-Agent': 'BeachAccommodationFinder/1.0 (Educational Project)'
-        }
-        
         # Gọi API với delay để tránh rate limit
+        # (User-Agent bắt buộc đã được gắn sẵn trong session)
         time.sleep(1)
-        response = requests.get(url, params=params, headers=headers, timeout=10)
+        response = _SESSION.get(url, params=params, timeout=10)
         
         # Kiểm tra status code
         if response.status_code != 200:
             return None, f"Nominatim API trả về lỗi: {response.status_code}"
         
         # Parse JSON
-        data = response.json()
+        data = orjson.loads(response.content)
         
         # Kiểm tra có kết quả không
         if not data or len(data) == 0:
@@ -136,6 +286,8 @@ def validate_and_geocode(location_name: str) -> Tuple[Optional[Dict], Optional[s
             'importance': result.get('importance', 0)
         }
         
+        _GEO_CACHE.set(cache_key, geo_data)
+        
         return geo_data, None
         
     except requests.exceptions.Timeout:
@@ -150,6 +302,61 @@ def validate_and_geocode(location_name: str) -> Tuple[Optional[Dict], Optional[s
 # PATTERN 3: NORMALIZE INPUT FILTERS
 # ============================================================================
 
+# Từ điển map budget (key đã chuẩn hóa: chữ thường, không khoảng trắng thừa)
+_BUDGET_MAP = {
+    'rẻ': 'low',
+    'giá rẻ': 'low',
+    'cheap': 'low',
+    'bình thường': 'medium',
+    'trung bình': 'medium',
+    'normal': 'medium',
+    'cao': 'high',
+    'đắt': 'high',
+    'sang trọng': 'high',
+    'luxury': 'high'
+}
+
+# Từ điển map accommodation type sang OSM tourism tags
+_TYPE_MAP = {
+    'homestay': 'guest_house',
+    'nhà nghỉ': 'guest_house',
+    'khách sạn': 'hotel',
+    'hotel': 'hotel',
+    'resort': 'resort',
+    'villa': 'chalet',
+    'biệt thự': 'chalet',
+    'hostel': 'hostel',
+    'ký túc xá': 'hostel'
+}
+
+# Từ điển map ambiance tags
+_AMBIANCE_MAP = {
+    'yên tĩnh': 'quiet',
+    'quiet': 'quiet',
+    'peaceful': 'quiet',
+    'sôi động': 'lively',
+    'lively': 'lively',
+    'vibrant': 'lively',
+    'gần biển': 'beachfront',
+    'beach': 'beachfront',
+    'beachfront': 'beachfront',
+    'view đẹp': 'scenic',
+    'scenic': 'scenic',
+    'gia đình': 'family',
+    'family': 'family',
+    'romantic': 'romantic',
+    'lãng mạn': 'romantic'
+}
+
+# Tag mới phải được thêm vào TAG_VOCABULARY, nếu không filter sẽ không
+# khớp được nơi ở nào có tag đó
+assert set(_AMBIANCE_MAP.values()) <= set(TAG_VOCABULARY), \
+    f"Tag chưa có trong TAG_VOCABULARY: {set(_AMBIANCE_MAP.values()) - set(TAG_VOCABULARY)}"
+
+# Bảng thay dấu câu bằng khoảng trắng khi tách từ ambiance
+_PUNCT_TT = str.maketrans(',;./', '    ')
+
+
 def normalize_filters(budget_text: str, type_text: str, ambiance_text: str) -> Dict:
     """
     Chuẩn hóa các filter từ text sang giá trị chuẩn
@@ -162,65 +369,19 @@ def normalize_filters(budget_text: str, type_text: str, ambiance_text: str) -> D
     Returns:
         Dict chứa các giá trị đã chuẩn hóa
     """
-    # Từ điển map budget
-    budget_map = {
-        'rẻ': 'low',
-        'giá rẻ': 'low',
-        'cheap': 'low',
-        'bình thường': 'medium',
-        'trung bình': 'medium',
-        'normal': 'medium',
-        'cao': 'high',
-        'đắt': 'high',
-        'sang trọng': 'high',
-        'luxury': 'high'
-    }
-    
-    # Từ điển map accommodation type sang OSM tourism tags
-    type_map = {
-        'homestay': 'guest_house',
-        'nhà nghỉ': 'guest_house',
-        'khách sạn': 'hotel',
-        'hotel': 'hotel',
-        'resort': 'resort',
-        'villa': 'chalet',
-        'biệt thự': 'chalet',
-        'hostel': 'hostel',
-        'ký túc xá': 'hostel'
-    }
-    
-    # Từ điển map ambiance tags
-    ambiance_map = {
-        'yên tĩnh': 'quiet',
-        'quiet': 'quiet',
-        'peaceful': 'quiet',
-        'sôi động': 'lively',
-        'lively': 'lively',
-        'vibrant': 'lively',
-        'gần biển': 'beachfront',
-        'beach': 'beachfront',
-        'beachfront': 'beachfront',
-        'view đẹp': 'scenic',
-        'scenic': 'scenic',
-        'gia đình': 'family',
-        'family': 'family',
-        'romantic': 'romantic',
-        'lãng mạn': 'romantic'
-    }
-    
     # Normalize budget
-    budget_tier = budget_map.get(budget_text.lower().strip(), 'medium')
+    budget_tier = _BUDGET_MAP.get(budget_text.lower().strip(), 'medium')
     
     # Normalize type
-    acc_type = type_map.get(type_text.lower().strip(), 'guest_house')
+    acc_type = _TYPE_MAP.get(type_text.lower().strip(), 'guest_house')
     
     # Normalize ambiance tags
     tags = []
     if ambiance_text and ambiance_text.strip():
-        # Split bằng dấu phẩy hoặc space
-        words = [w.strip() for w in ambiance_text.replace(',', ' ').split()]
+        # Lowercase 1 lần, tách bằng dấu câu hoặc space
+        words = ambiance_text.lower().translate(_PUNCT_TT).split()
         for word in words:
-            tag = ambiance_map.get(word.lower())
+            tag = _AMBIANCE_MAP.get(word)
             if tag and tag not in tags:
                 tags.append(tag)
     
@@ -235,7 +396,38 @@ def normalize_filters(budget_text: str, type_text: str, ambiance_text: str) -> D
 # PATTERN 4: INTAKE INFORMATION (Build SearchRequest)
 # ============================================================================
 
-def build_search_request(geo_data: Dict, filters: Dict) -> Dict:
+# Các hằng số tìm kiếm (giống nhau cho mọi truy vấn) và giá trị suy ra từ
+# bán kính, tính sẵn 1 lần để filter đọc trực tiếp
+_SEARCH_CONSTANTS = MappingProxyType({
+    'radius': 5000,  # 5km radius (m)
+    'radius_km': 5.0,
+    'sin2_half_r_over_R': haversine_threshold(5.0),  # Ngưỡng Haversine của bán kính 5km
+    'max_results': 10
+})
+
+
+@dataclass(frozen=True, slots=True)
+class SearchRequest:
+    """
+    Toàn bộ thông tin để search (bất biến, dùng slots nên truy cập thuộc
+    tính nhanh và không tạo dict cho mỗi truy vấn)
+    """
+    location_name: str
+    lat: float
+    lon: float
+    budget: Optional[str]
+    type: Optional[str]
+    tags: Tuple[str, ...]
+    radius: int                    # Bán kính tìm kiếm (m)
+    radius_km: float
+    sin2_half_r_over_R: float      # Ngưỡng Haversine của bán kính
+    max_results: int
+    ruler: Tuple[float, float]     # Hệ số cheap ruler cho filter
+    cos_lat: float                 # cos vĩ độ điểm tìm kiếm
+    bbox: Tuple[float, float, float, float]  # Khung lọc nhanh
+
+
+def build_search_request(geo_data: Dict, filters: Dict) -> SearchRequest:
     """
     Tổng hợp tất cả thông tin thành SearchRequest object
     
@@ -244,17 +436,37 @@ def build_search_request(geo_data: Dict, filters: Dict) -> Dict:
         filters: Filters đã được normalize
     
     Returns:
-        Dict chứa đầy đủ thông tin để search
+        SearchRequest chứa đầy đủ thông tin để search
     """
-    search_request = {
-        'location_name': geo_data['name'],
-        'lat': geo_data['lat'],
-        'lon': geo_data['lon'],
-        'budget': filters['budget'],
-        'type': filters['type'],
-        'tags': filters['tags'],
-        'radius': 5000,  # 5km radius
-        'max_results': 10
-    }
+    return _build_search_request_cached(
+        geo_data['name'], geo_data['lat'], geo_data['lon'],
+        filters['budget'], filters['type'], tuple(filters['tags'])
+    )
+
+
+@lru_cache(maxsize=1024)
+def _build_search_request_cached(location_name: str, lat: float, lon: float, budget: str,
+                                 acc_type: str, tags: Tuple[str, ...]) -> SearchRequest:
+    """
+    Dựng SearchRequest (cache theo input, cùng truy vấn lặp lại không phải
+    tính lại các hệ số; SearchRequest bất biến nên trả thẳng bản trong cache)
+    
+    Args:
+        location_name, lat, lon: Dữ liệu địa lý từ geocoding
+        budget, acc_type, tags: Filters đã được normalize
     
-    return search_request
\ No newline at end of file
+    Returns:
+        SearchRequest chứa đầy đủ thông tin để search
+    """
+    return SearchRequest(
+        **_SEARCH_CONSTANTS,
+        location_name=location_name,
+        lat=lat,
+        lon=lon,
+        budget=budget,
+        type=acc_type,
+        tags=tags,
+        ruler=make_ruler(lat),
+        cos_lat=math.cos(math.radians(lat)),
+        bbox=bounding_box(lat, lon, _SEARCH_CONSTANTS['radius_km'])
+    )
\ No newline at end of file
@@ -2,8 +2,25 @@
 Helper functions - Các hàm tiện ích
 """
 
+import json
 import math
-from typing import Tuple
+import os
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Bộ tags chuẩn mà user có thể yêu cầu: mọi giá trị của ambiance map trong
+# input_processing phải nằm ở đây (được kiểm tra khi import) vì
+# backend_execution gán bit cho từng tag theo đúng bộ này
+TAG_VOCABULARY = ('quiet', 'lively', 'beachfront', 'scenic', 'family', 'romantic')
+
+# Thư mục lưu cache (nằm ở thư mục gốc của project)
+CACHE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '.cache')
 
 
 def haversine_distance(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
@@ -36,6 +53,150 @@ def haversine_distance(lat1: float, lon1: float, lat2: float, lon2: float) -> fl
     return radius * c
 
 
+def haversine_threshold(radius_km: float) -> float:
+    """
+    Đổi bán kính sang ngưỡng của đại lượng a = sin²(c/2) trong công thức
+    Haversine (a tăng đơn điệu theo khoảng cách)
+    
+    Args:
+        radius_km: Bán kính (km)
+    
+    Returns:
+        sin²(radius / 2R)
+    """
+    return math.sin(radius_km / (2 * 6371.0))**2
+
+
+def haversine_a_rad(lat1_rad: float, lon1_rad: float, cos_lat1: float,
+                    lats_rad: np.ndarray, lons_rad: np.ndarray, cos_lats: np.ndarray) -> np.ndarray:
+    """
+    Tính đại lượng a của Haversine từ các giá trị radian/cos đã tính sẵn
+    (vd: cos vĩ độ điểm tìm kiếm trong SearchRequest), chỉ còn 2 lần sin
+    cho mỗi điểm
+    
+    Args:
+        lat1_rad, lon1_rad, cos_lat1: Điểm gốc (radian) và cos vĩ độ
+        lats_rad, lons_rad, cos_lats: Các điểm cần tính (radian) và cos vĩ độ
+    
+    Returns:
+        Mảng giá trị a
+    """
+    dlat = lats_rad - lat1_rad
+    dlon = lons_rad - lon1_rad
+    
+    return np.sin(dlat * 0.5)**2 + cos_lat1 * cos_lats * np.sin(dlon * 0.5)**2
+
+
+def haversine_a_to_km(a):
+    """Đổi đại lượng a của Haversine sang khoảng cách (km), scalar hoặc mảng"""
+    return 6371.0 * 2.0 * np.arcsin(np.sqrt(a))
+
+
+# Bán kính tối đa (km) mà phép tính xấp xỉ "cheap ruler" vẫn đủ chính xác
+CHEAP_RULER_MAX_KM = 50.0
+
+
+def lat_band_deg(radius_km: float) -> float:
+    """
+    Nửa độ rộng (độ vĩ) của dải vĩ độ chứa trọn bán kính tìm kiếm
+    
+    Args:
+        radius_km: Bán kính (km)
+    
+    Returns:
+        Số độ vĩ tương ứng
+    """
+    # 110.57 km/độ nhỏ hơn hệ số của Haversine (6371 km ⇒ 111.19 km/độ) nên
+    # dải này chứa đủ kết quả cho cả cheap ruler lẫn Haversine
+    return radius_km / 110.57
+
+
+def make_ruler(lat0: float) -> Tuple[float, float]:
+    """
+    Tính hệ số đổi độ → km quanh vĩ độ lat0 (xấp xỉ equirectangular/FCC),
+    chỉ cần tính 1 lần cho mỗi điểm tìm kiếm
+    
+    Args:
+        lat0: Vĩ độ của điểm tìm kiếm
+    
+    Returns:
+        Tuple (kx, ky): số km trên 1 độ kinh độ và 1 độ vĩ độ
+    """
+    return 111.32 * math.cos(math.radians(lat0)), 110.57
+
+
+def ruler_distance_sq(ruler: Tuple[float, float], lat0: float, lon0: float, lats, lons):
+    """
+    Tính bình phương khoảng cách theo cheap ruler (không cần trig, không
+    cần sqrt), dùng được cho cả scalar lẫn mảng NumPy
+    
+    Args:
+        ruler: Tuple (kx, ky) từ make_ruler(lat0)
+        lat0, lon0: Tọa độ điểm tìm kiếm
+        lats, lons: Tọa độ các điểm cần tính
+    
+    Returns:
+        Bình phương khoảng cách (km²)
+    """
+    kx, ky = ruler
+    # Đưa chênh lệch kinh độ về [-180, 180) để không sai khi vượt kinh tuyến 180
+    dx = ((lons - lon0 + 180.0) % 360.0 - 180.0) * kx
+    dy = (lats - lat0) * ky
+    return dx * dx + dy * dy
+
+
+def bounding_box(lat0: float, lon0: float, radius_km: float) -> Tuple[float, float, float, float]:
+    """
+    Tính khung lat/lon chứa trọn vòng tròn bán kính radius_km quanh điểm
+    tìm kiếm, dùng để loại nhanh các điểm ở xa trước khi tính khoảng cách
+    
+    Args:
+        lat0, lon0: Tọa độ điểm tìm kiếm
+        radius_km: Bán kính (km)
+    
+    Returns:
+        Tuple (lat_min, lat_max, lon_min, lon_max); lon_min/lon_max có thể
+        vượt ra ngoài [-180, 180] khi khung cắt kinh tuyến 180
+    """
+    band = lat_band_deg(radius_km)
+    lat_min, lat_max = lat0 - band, lat0 + band
+    
+    # Khung chạm cực: mọi kinh độ đều có thể nằm trong bán kính
+    if lat_min <= -90.0 or lat_max >= 90.0:
+        return lat_min, lat_max, -180.0, 180.0
+    
+    if radius_km <= CHEAP_RULER_MAX_KM:
+        # Đúng bằng giới hạn của cheap ruler quanh lat0
+        dlon = radius_km / make_ruler(lat0)[0]
+    else:
+        # Độ lệch kinh độ lớn nhất của vòng tròn trên mặt cầu
+        ratio = math.sin(radius_km / 6371.0) / math.cos(math.radians(lat0))
+        if ratio >= 1.0:
+            return lat_min, lat_max, -180.0, 180.0
+        dlon = math.degrees(math.asin(ratio))
+    
+    return lat_min, lat_max, lon0 - dlon, lon0 + dlon
+
+
+def lon_in_box(lons, lon_min: float, lon_max: float):
+    """
+    Kiểm tra kinh độ nằm trong khoảng [lon_min, lon_max], xử lý trường hợp
+    khung vượt kinh tuyến 180 bằng cách tách thành 2 khoảng
+    
+    Args:
+        lons: Mảng kinh độ
+        lon_min, lon_max: Khoảng kinh độ từ bounding_box()
+    
+    Returns:
+        Mảng bool
+    """
+    if lon_max > 180.0:
+        return (lons >= lon_min) | (lons <= lon_max - 360.0)
+    if lon_min < -180.0:
+        return (lons >= lon_min + 360.0) | (lons <= lon_max)
+    return (lons >= lon_min) & (lons <= lon_max)
+
+
 def format_distance(distance_km: float) -> str:
     """
     Format khoảng cách để hiển thị
@@ -46,9 +207,26 @@ def format_distance(distance_km: float) -> str:
     Returns:
         String đã format (vd: "2.5 km" hoặc "850 m")
     """
-    if distance_km < 1:
-        return f"{int(distance_km * 1000)} m"
-    return f"{distance_km:.1f} km"
+    return str(format_distance_array(np.array([distance_km], dtype=np.float64))[0])
+
+
+def format_distance_array(distances_km: np.ndarray) -> np.ndarray:
+    """
+    Format nhiều khoảng cách cùng lúc (vòng lặp nằm trong NumPy)
+    
+    Args:
+        distances_km: Mảng khoảng cách tính bằng km
+    
+    Returns:
+        Mảng string đã format (vd: "2.5 km" hoặc "850 m")
+    """
+    distances_km = np.asarray(distances_km, dtype=np.float64)
+    meters = (distances_km * 1000).astype(np.int64)  # Cắt phần lẻ như int()
+    
+    m_str = np.char.add(meters.astype(str), ' m')
+    km_str = np.char.mod('%.1f km', distances_km)
+    
+    return np.where(distances_km < 1, m_str, km_str)
 
 
 def safe_get(dictionary: dict, key: str, default=None):
@@ -63,7 +241,110 @@ def safe_get(dictionary: dict, key: str, default=None):
     Returns:
         Giá trị hoặc default
     """
-    try:
-        return dictionary.get(key, default)
-    except:
-        return default
\ No newline at end of file
+    # dict.get không raise khi thiếu key; chỉ cần chặn input không phải dict
+    return dictionary.get(key, default) if isinstance(dictionary, dict) else default
+
+
+def create_http_session(user_agent: str,
+                        retry_statuses: Tuple[int, ...] = (429, 502, 503, 504)) -> requests.Session:
+    """
+    Tạo HTTP session dùng chung (giữ kết nối keep-alive, connection pool)
+    có tự động retry với backoff khi server quá tải
+    
+    Args:
+        user_agent: User-Agent gửi kèm mọi request (OSM bắt buộc phải có)
+        retry_statuses: Các HTTP status sẽ được tự động retry
+    
+    Returns:
+        requests.Session đã cấu hình
+    """
+    retry = Retry(
+        total=2,
+        read=False,  # Không gửi lại khi read timeout, để raise Timeout như cũ
+        backoff_factor=0.5,
+        status_forcelist=retry_statuses,
+        allowed_methods=frozenset(['GET', 'POST']),
+        raise_on_status=False  # Hết lượt retry thì trả về response để tự xử lý
+    )
+    
+    session = requests.Session()
+    session.headers.update({'User-Agent': user_agent})
+    session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry))
+    
+    return session
+
+
+class JsonFileCache:
+    """
+    Cache dạng key -> value, giữ trong bộ nhớ và lưu ra file JSON
+    để dùng lại giữa các lần chạy app
+
+    Args:
+        filename: Tên file JSON trong thư mục CACHE_DIR
+        ttl: Thời gian sống của mỗi entry (giây), None = không hết hạn
+        max_entries: Số entry tối đa, vượt quá thì xóa các entry cũ nhất
+    """
+
+    def __init__(self, filename: str, ttl: Optional[float] = None, max_entries: int = 1000):
+        self.path = os.path.join(CACHE_DIR, filename)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._data = self._load()
+
+    def _load(self) -> Dict:
+        """Đọc cache từ file (file hỏng hoặc chưa có thì trả về dict rỗng)"""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(data, dict):
+            return {}
+
+        # Sắp xếp theo thời gian lưu (cũ trước) để _prune xóa từ đầu dict
+        data = dict(sorted(data.items(), key=lambda item: item[1].get('saved_at', 0)))
+        self._prune(data)
+        return data
+
+    def _prune(self, data: Dict) -> None:
+        """Xóa các entry đã hết hạn và các entry cũ nhất nếu vượt max_entries"""
+        if self.ttl is not None:
+            expired_before = time.time() - self.ttl
+            for key in [k for k, entry in data.items() if entry.get('saved_at', 0) < expired_before]:
+                del data[key]
+
+        # dict giữ thứ tự thêm vào nên entry đầu tiên là entry cũ nhất
+        while len(data) > self.max_entries:
+            del data[next(iter(data))]
+
+    def get(self, key: str) -> Optional[Any]:
+        """
+        Lấy giá trị từ cache
+
+        Returns:
+            Giá trị đã lưu hoặc None nếu không có / đã hết hạn
+        """
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        if self.ttl is not None and time.time() - entry['saved_at'] > self.ttl:
+            return None
+        return entry['value']
+
+    def set(self, key: str, value: Any) -> None:
+        """Lưu giá trị vào cache và ghi lại file JSON"""
+        with self._lock:
+            # Xóa key cũ trước để entry mới nằm cuối dict (mới nhất)
+            self._data.pop(key, None)
+            self._data[key] = {'saved_at': time.time(), 'value': value}
+            self._prune(self._data)
+            try:
+                os.makedirs(CACHE_DIR, exist_ok=True)
+                tmp_path = self.path + '.tmp'
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(self._data, f, ensure_ascii=False)
+                os.replace(tmp_path, self.path)
+            except OSError:
+                # Không ghi được file thì vẫn giữ cache trong bộ nhớ
+                pass
\ No newline at end of file